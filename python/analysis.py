@@ -1,9 +1,10 @@
 # conda create -n coffea_torch coffea pytorch
 # conda activate coffea_torch
 
-import time, pickle, os, argparse
+import time, pickle, os, argparse, threading
 import awkward as ak
 import numpy as np
+import numba
 from functools import partial
 
 # https://hist.readthedocs.io/en/latest/index.html
@@ -12,8 +13,6 @@ import hist
 # https://coffeateam.github.io/coffea
 from coffea.nanoevents import NanoEventsFactory, NanoAODSchema, BaseSchema
 from coffea import processor, util
-from coffea.nanoevents.methods import vector
-ak.behavior.update(vector.behavior)
 from ClassifierSchema import ClassifierSchema
 
 NanoAODSchema.warn_missing_crossrefs = False
@@ -21,6 +20,178 @@ import warnings
 warnings.filterwarnings("ignore")
 
 
+# diJet selection constants for the lead/subl st diJets, shaped to broadcast against [event,pairing,lead/subl st]
+# diJetMass cut with independent min/max for lead/subl
+minDiJetMass = np.array([[[ 52, 50]]], dtype=np.float32)
+maxDiJetMass = np.array([[[180,173]]], dtype=np.float32)
+# sliding window delta_r criteria (drc), scaled by 1/m4j
+min_m4j_scale = np.array([[ 360, 235]], dtype=np.float32)
+min_dr_offset = np.array([[-0.5, 0.0]], dtype=np.float32)
+max_m4j_scale = np.array([[ 650, 650]], dtype=np.float32)
+max_dr_offset = np.array([[ 0.5, 0.7]], dtype=np.float32)
+max_dr        = np.array([[ 1.5, 1.5]], dtype=np.float32)
+# consistency of diJet masses with higgs boson mass
+mH = np.float32(125.0)
+st_bias = np.array([[[1.02, 0.98]]], dtype=np.float32)
+cH = mH * st_bias
+max_xHH = np.float32(1.9)
+
+@numba.njit(cache=True, fastmath=True)
+def delta_phi(phi1, phi2):
+    return (phi1 - phi2 + np.float32(np.pi)) % np.float32(2*np.pi) - np.float32(np.pi)
+
+@numba.njit(cache=True, fastmath=True, inline='always')
+def diJet_kinematics(a, b, pt, eta, phi, px, py, pz, E):
+    Ejj, pxjj, pyjj, pzjj = E[a]+E[b], px[a]+px[b], py[a]+py[b], pz[a]+pz[b]
+    deta, dphi = eta[a]-eta[b], delta_phi(phi[a], phi[b])
+    mass = np.sqrt(max(Ejj*Ejj - pxjj*pxjj - pyjj*pyjj - pzjj*pzjj, np.float32(0)))
+    st   = pt[a] + pt[b]
+    dr   = np.sqrt(deta*deta + dphi*dphi)
+    return mass, st, dr
+
+@numba.njit(cache=True, fastmath=True, inline='always')
+def quadJet(a0, b0, a1, b1, pt, eta, phi, px, py, pz, E, m4j, random):
+    """
+    Build the quadJet of diJets (a0,b0) and (a1,b1) for a single event. Returns its rank, diJetMass and SR
+    flags and the mass and delta_r of the lead/subl st diJets.
+    """
+    lead_mass, lead_st, lead_dr = diJet_kinematics(a0, b0, pt, eta, phi, px, py, pz, E)
+    subl_mass, subl_st, subl_dr = diJet_kinematics(a1, b1, pt, eta, phi, px, py, pz, E)
+    # Sort diJets within pairing to be lead st, subl st
+    if lead_st < subl_st:
+        lead_mass, subl_mass = subl_mass, lead_mass
+        lead_dr,   subl_dr   = subl_dr,   lead_dr
+
+    # diJetMass cut with independent min/max for lead/subl
+    lead_diJetMass = (minDiJetMass[0,0,0] < lead_mass) and (lead_mass < maxDiJetMass[0,0,0])
+    subl_diJetMass = (minDiJetMass[0,0,1] < subl_mass) and (subl_mass < maxDiJetMass[0,0,1])
+
+    # sliding window delta_r criteria (drc)
+    lead_drc = (min_m4j_scale[0,0]/m4j + min_dr_offset[0,0] < lead_dr) and (lead_dr < max(max_m4j_scale[0,0]/m4j + max_dr_offset[0,0], max_dr[0,0]))
+    subl_drc = (min_m4j_scale[0,1]/m4j + min_dr_offset[0,1] < subl_dr) and (subl_dr < max(max_m4j_scale[0,1]/m4j + max_dr_offset[0,1], max_dr[0,1]))
+
+    # consistency of diJet masses with higgs boson mass
+    lead_xH = (lead_mass - cH[0,0,0])/(np.float32(0.1)*lead_mass)
+    subl_xH = (subl_mass - cH[0,0,1])/(np.float32(0.1)*subl_mass)
+    xHH = np.sqrt(lead_xH*lead_xH + subl_xH*subl_xH)
+
+    # rank quadJets at random giving preference to ones which pass diJetMass and drc's
+    rank = 10*lead_diJetMass + 10*subl_diJetMass + lead_drc + subl_drc + random
+    return rank, lead_diJetMass and subl_diJetMass, xHH < max_xHH, lead_mass, subl_mass, lead_dr, subl_dr
+
+@numba.njit(cache=True, parallel=True, fastmath=True)
+def process_events(pt, eta, phi, px, py, pz, E, random, m4j, preselection, selected, SR, SB, diJetMass, m2j, dr2j):
+    """
+    Apply the jet preselection and build the three diJet pairings of each four jet event in a single pass over
+    (N,4) jet arrays. Writes m4j, the preselection flag, the selected pairing, the SR/SB/diJetMass flags of the
+    selected pairing and the mass and delta_r of its lead/subl st diJets as arrays of shape (N,2) into the given
+    output arrays, so no intermediate per-jet or per-pairing arrays are stored.
+    """
+    N = pt.shape[0]
+    for i in numba.prange(N):
+        # Jet selection
+        nJet_selected = 0
+        for j in range(4):
+            nJet_selected += (pt[i,j] >= np.float32(40)) and (abs(eta[i,j]) <= np.float32(2.4))
+        preselection[i] = nJet_selected >= 4
+
+        # mass of sum of jets, for the toy samples there are always four jets
+        PX = px[i,0] + px[i,1] + px[i,2] + px[i,3]
+        PY = py[i,0] + py[i,1] + py[i,2] + py[i,3]
+        PZ = pz[i,0] + pz[i,1] + pz[i,2] + pz[i,3]
+        EE =  E[i,0] +  E[i,1] +  E[i,2] +  E[i,3]
+        m4j[i] = np.sqrt(max(EE*EE - PX*PX - PY*PY - PZ*PZ, np.float32(0)))
+
+        # The three pairings of the four jets are spelled out so the jet indices are compile time constants
+        q0 = quadJet(0, 1, 2, 3, pt[i], eta[i], phi[i], px[i], py[i], pz[i], E[i], m4j[i], random[i,0])
+        q1 = quadJet(0, 2, 1, 3, pt[i], eta[i], phi[i], px[i], py[i], pz[i], E[i], m4j[i], random[i,1])
+        q2 = quadJet(0, 3, 1, 2, pt[i], eta[i], phi[i], px[i], py[i], pz[i], E[i], m4j[i], random[i,2])
+
+        # select the quadJet with the highest rank
+        if q0[0] >= q1[0] and q0[0] >= q2[0]:
+            q, selected[i] = q0, 0
+        elif q1[0] >= q2[0]:
+            q, selected[i] = q1, 1
+        else:
+            q, selected[i] = q2, 2
+
+        diJetMass[i] = q[1]
+        SR[i] = q[2]
+        SB[i] = q[1] and not q[2]
+        m2j [i,0], m2j [i,1] = q[3], q[4]
+        dr2j[i,0], dr2j[i,1] = q[5], q[6]
+
+scratch_buffers = threading.local()
+
+def scratch(name, shape, dtype=np.float32):
+    """
+    Return an uninitialized array of the given shape backed by a per-thread buffer which is reused by every chunk
+    and only reallocated when a chunk needs more space. The contents are overwritten by the next chunk.
+    """
+    size = int(np.prod(shape))
+    buffer = getattr(scratch_buffers, name, None)
+    if buffer is None or buffer.size < size or buffer.dtype != dtype:
+        buffer = np.empty(size, dtype=dtype)
+        setattr(scratch_buffers, name, buffer)
+    return buffer[:size].reshape(shape)
+
+def cartesian(pt, eta, phi, mass):
+    """
+    Compute px, py, pz, E from pt, eta, phi, mass arrays, writing into scratch buffers.
+    """
+    px = np.cos (phi, out=scratch('px', pt.shape)); px *= pt
+    py = np.sin (phi, out=scratch('py', pt.shape)); py *= pt
+    pz = np.sinh(eta, out=scratch('pz', pt.shape)); pz *= pt
+    E  = np.hypot(pt, pz, out=scratch('E', pt.shape)); np.hypot(E, mass, out=E)
+    return px, py, pz, E
+
+def gather(jet, idx):
+    """
+    Gather per-event jet indices idx[event,...] from an (N,4) jet array.
+    """
+    return np.take_along_axis(jet, idx.reshape(len(idx), -1), axis=1).reshape(idx.shape)
+
+def batch_selections(selections):
+    """
+    Concatenate a list of (cut, region, mask) selections into per-entry cut and region bin indices
+    and the indices of the selected events, so each histogram can be filled in a single call.
+    """
+    idx    = [np.flatnonzero(mask) for _, _, mask in selections]
+    cut    = np.concatenate([np.full(len(i), cut_axis.index(c))    for (c, _, _), i in zip(selections, idx)])
+    region = np.concatenate([np.full(len(i), region_axis.index(r)) for (_, r, _), i in zip(selections, idx)])
+    return cut, region, np.concatenate(idx)
+
+
+cut_axis    = hist.axis.StrCategory(['all', 'preselection'],                   name='cut',    label='Cut')
+region_axis = hist.axis.StrCategory(['inclusive', 'diJetMass', 'SB', 'SR'], name='region', label='Region')
+hist_axes = {'cutflow': [],
+             'm4j': [hist.axis.Regular(300, 0, 1500, name='mass', label=r'$m_{4j}$ [GeV]')],
+             'lead_st_m2j_subl_st_m2j': [hist.axis.Regular(100, 0, 500, name='lead', label=   r'Lead $S_{T}$ $m_{2j}$ [GeV]'),
+                                         hist.axis.Regular(100, 0, 500, name='subl', label=r'Sublead $S_{T}$ $m_{2j}$ [GeV]')],
+             'lead_st_dr_subl_st_dr': [hist.axis.Regular(60, 0, 6, name='lead', label=   r'Lead $S_T$ $\Delta R(j,j)$'),
+                                       hist.axis.Regular(60, 0, 6, name='subl', label=r'Sublead $S_T$ $\Delta R(j,j)$')],
+             'FvT_rw': [hist.axis.Regular(50, 0, 2.5, name='rw', label='FvT P(D4)/P(D3)')],
+             }
+
+def book(name, *category_axes):
+    """
+    Book hist name, binned in category_axes (if any) followed by cut, region and the axes in hist_axes[name].
+    """
+    return hist.Hist(*category_axes, cut_axis, region_axis, *hist_axes[name], storage='weight', label='Events')
+
+def fill(name, cut, region, *values, weight):
+    """
+    Fill [sumw, sumw2] arrays matching the flow view of book(name) from cut/region bin indices and one value array
+    per axis in hist_axes[name]. Values are binned with np.digitize on the axis edges, which puts them in the same
+    underflow/overflow bins as hist.
+    """
+    axes  = [cut_axis, region_axis, *hist_axes[name]]
+    shape = tuple(axis.extent for axis in axes)
+    index = np.ravel_multi_index([cut, region] + [np.digitize(value, axis.edges) for value, axis in zip(values, hist_axes[name])], shape)
+    sumw  = np.bincount(index, weights=weight,        minlength=np.prod(shape))
+    sumw2 = np.bincount(index, weights=weight*weight, minlength=np.prod(shape))
+    return np.stack([sumw, sumw2]).reshape((2,)+shape)
+
 
 class analysis(processor.ProcessorABC):
     def __init__(self, save=False, fvt='FvT'):
@@ -30,7 +201,6 @@ class analysis(processor.ProcessorABC):
     
     def process(self, event):
         tstart = time.time()
-        np.random.seed(0)
         
         fname   = event.metadata['filename']
         dataset = event.metadata['dataset']
@@ -38,174 +208,182 @@ class analysis(processor.ProcessorABC):
         estop   = event.metadata['entrystop']
         chunk   = f'{dataset}::{estart:6d}:{estop:6d} >>> '
         norm    = event.metadata.get('normalize', None)
+        N       = len(event)
+        # Per event quantities are kept as numpy arrays, event is only updated when it is saved
+        weight  = ak.to_numpy(event.weight)
         if norm:
             with open(norm, 'rb') as nfile:
                 norm = pickle.load(nfile)['norm']
-                event['weight'] = norm * event.weight
+                weight = norm * weight
 
         fvt_path = dataset.replace('picoAOD', self.fvt)
         fvt_exists = os.path.exists(fvt_path)
         if fvt_exists:
-            event['FvT'] = NanoEventsFactory.from_root(fvt_path, entry_start=estart, entry_stop=estop, schemaclass=ClassifierSchema).events().FvT
+            FvT = NanoEventsFactory.from_root(fvt_path, entry_start=estart, entry_stop=estop, schemaclass=ClassifierSchema).events().FvT
+            rw = ak.to_numpy(FvT.rw)
 
         if event.metadata.get('reweight', False) and 'threeTag' in dataset:
-            event['weight'] = event.FvT.rw * event.weight
-
-        dataset_axis = hist.axis.StrCategory([], growth=True, name='dataset', label='Dataset')
-        cut_axis     = hist.axis.StrCategory([], growth=True, name='cut',     label='Cut')
-        region_axis  = hist.axis.StrCategory([], growth=True, name='region',  label='Region')
+            weight = rw * weight
 
         output = {'hists': {},
-                  'cutflow': hist.Hist(dataset_axis, cut_axis, region_axis, storage='weight', label='Events'),
-                  'sumw': ak.sum(event.weight),
-                  'nEvent': len(event)}
-
-        m4j_axis = hist.axis.Regular(300, 0, 1500, name='mass', label=r'$m_{4j}$ [GeV]')
-        output['hists']['m4j'] = hist.Hist(dataset_axis,
-                                           cut_axis,
-                                           region_axis,
-                                           m4j_axis,
-                                           storage='weight', label='Events')
-
-        lead_st_m2j_axis = hist.axis.Regular(100, 0, 500, name='lead', label=   r'Lead $S_{T}$ $m_{2j}$ [GeV]')
-        subl_st_m2j_axis = hist.axis.Regular(100, 0, 500, name='subl', label=r'Sublead $S_{T}$ $m_{2j}$ [GeV]')
-        output['hists']['lead_st_m2j_subl_st_m2j'] = hist.Hist(dataset_axis,
-                                                               cut_axis,
-                                                               region_axis,
-                                                               lead_st_m2j_axis,
-                                                               subl_st_m2j_axis,
-                                                               storage='weight', label='Events')
-        lead_st_dr_axis = hist.axis.Regular(60, 0, 6, name='lead', label=   r'Lead $S_T$ $\Delta R(j,j)$')
-        subl_st_dr_axis = hist.axis.Regular(60, 0, 6, name='subl', label=r'Sublead $S_T$ $\Delta R(j,j)$')
-        output['hists']['lead_st_dr_subl_st_dr'] = hist.Hist(dataset_axis,
-                                                             cut_axis,
-                                                             region_axis,
-                                                             lead_st_dr_axis,
-                                                             subl_st_dr_axis,
-                                                             storage='weight', label='Events')
-
-        if fvt_exists:
-            fvt_axis = hist.axis.Regular(50, 0, 2.5, name='rw', label='FvT P(D4)/P(D3)')
-            output['hists']['FvT_rw'] = hist.Hist(dataset_axis,
-                                                  cut_axis,
-                                                  region_axis,
-                                                  fvt_axis,
-                                                  storage='weight', label='Events')
+                  'cutflow': {},
+                  'sumw': np.sum(weight),
+                  'nEvent': N}
 
-        # compute four-vector of sum of jets, for the toy samples there are always four jets
-        v4j = event.Jet.sum(axis=1)
-        event['v4j'] = v4j
+        # Contiguous (N,4) float32 jet arrays, for the toy samples there are always four jets
+        jet_pt   = ak.to_numpy(ak.flatten(event.Jet.pt  )).astype(np.float32, copy=False).reshape(-1,4)
+        jet_eta  = ak.to_numpy(ak.flatten(event.Jet.eta )).astype(np.float32, copy=False).reshape(-1,4)
+        jet_phi  = ak.to_numpy(ak.flatten(event.Jet.phi )).astype(np.float32, copy=False).reshape(-1,4)
+        jet_mass = ak.to_numpy(ak.flatten(event.Jet.mass)).astype(np.float32, copy=False).reshape(-1,4)
+        jet_px, jet_py, jet_pz, jet_E = cartesian(jet_pt, jet_eta, jet_phi, jet_mass)
 
-        output['cutflow'].fill(dataset=dataset, cut='all', region=['inclusive']*len(event), weight=event.weight) # bug in boost_histogram, waiting for fix, https://github.com/scikit-hep/boost-histogram/issues/452
-        output['hists']['m4j'].fill(dataset=dataset, cut='all', region='inclusive', mass=event.v4j.mass, weight=event.weight)
+        #
+        # Apply the jet selection and build diJets and quadJets in a single compiled pass over the (N,4) jet arrays
+        #
+        # random numbers in [0.1,0.9) to break ties in the quadJet rank. The Philox counter starts at the chunk entry
+        # so each chunk gets its own reproducible stream without touching the global numpy random state
+        rng = np.random.Generator(np.random.Philox(0, counter=estart))
+        random = rng.random(dtype=np.float32, out=scratch('random', (N,3)))
+        random *= 0.8
+        random += 0.1
+        m4j          = scratch('m4j',          (N,))
+        preselection = scratch('preselection', (N,),  np.bool_)
+        selected     = scratch('selected',     (N,),  np.int64)
+        SR           = scratch('SR',           (N,),  np.bool_)
+        SB           = scratch('SB',           (N,),  np.bool_)
+        diJetMass    = scratch('diJetMass',    (N,),  np.bool_)
+        m2j          = scratch('m2j',          (N,2))
+        dr2j         = scratch('dr2j',         (N,2))
+        process_events(jet_pt, jet_eta, jet_phi, jet_px, jet_py, jet_pz, jet_E, random, m4j, preselection, selected, SR, SB, diJetMass, m2j, dr2j)
 
-        # Jet selection
-        event['Jet', 'selected'] = (event.Jet.pt>=40) & (np.abs(event.Jet.eta)<=2.4)
-        event['nJet_selected'] = ak.sum(event.Jet.selected, axis=1)
-        event['preselection'] = (event.nJet_selected>=4)
-        #event = event[event.nJet_selected>=4]
+        #
+        # Fill histograms, batching all (cut, region) selections into a single fill call per histogram
+        #
+        selections = [('preselection', 'inclusive', preselection),
+                      ('preselection', 'diJetMass', preselection & diJetMass),
+                      ('preselection', 'SB',        preselection & SB),
+                      ('preselection', 'SR',        preselection & SR)]
+        cutflow_selections = [('all',          'inclusive', np.ones(N, dtype=bool)),
+                              ('preselection', 'inclusive', preselection)] + selections
+
+        # Chunks return plain [sumw, sumw2] arrays, merged by array addition and converted to hists in postprocess
+        cut, region, idx = batch_selections(cutflow_selections)
+        output['cutflow'][dataset] =          fill('cutflow', cut, region,           weight=weight[idx])
+        output['hists']['m4j']     = {dataset: fill('m4j',     cut, region, m4j[idx], weight=weight[idx])}
+
+        cut, region, idx = batch_selections(selections)
+        output['hists']['lead_st_m2j_subl_st_m2j'] = {dataset: fill('lead_st_m2j_subl_st_m2j', cut, region, m2j [idx,0], m2j [idx,1], weight=weight[idx])}
+        output['hists']['lead_st_dr_subl_st_dr'  ] = {dataset: fill('lead_st_dr_subl_st_dr',   cut, region, dr2j[idx,0], dr2j[idx,1], weight=weight[idx])}
+        if fvt_exists:
+            output['hists']['FvT_rw'] = {dataset: fill('FvT_rw', cut, region, rw[idx], weight=weight[idx])}
 
-        selev = event[event.preselection]
-        output['cutflow'].fill(dataset=dataset, cut='preselection', region=['inclusive']*len(selev), weight=selev.weight)
-        output['hists']['m4j'].fill(dataset=dataset, cut='preselection', region='inclusive', mass=selev.v4j.mass, weight=selev.weight)
+        if self.save:
+            event['weight'] = weight
+            if fvt_exists:
+                event['FvT'] = FvT
+            event['preselection'] = preselection
+            event['diJetMass'] = diJetMass
+            event['SB'] = SB
+            event['SR'] = SR
+            self.build_quadJets(event, jet_pt, jet_eta, jet_phi, jet_mass, jet_px, jet_py, jet_pz, jet_E, m4j, random, selected)
+            util.save(event, dataset.replace('.root',f'_{estart:07d}_{estop:07d}.coffea'))
+                
+        # Done
+        elapsed = time.time() - tstart
+        if self.debug: print(f'{chunk}{nEvent/elapsed:,.0f} events/s')
+        return output
 
+    def build_quadJets(self, event, jet_pt, jet_eta, jet_phi, jet_mass, jet_px, jet_py, jet_pz, jet_E, m4j, random, selected):
         #
         # Build diJets, indexed by diJet[event,pairing,0/1]
         #
-        pairing = [([0,2],[0,1],[0,1]),
-                   ([1,3],[2,3],[3,2])]
-        diJet         = event.Jet[:,pairing[0]]     +   event.Jet[:,pairing[1]]
-        diJet['st']   = event.Jet[:,pairing[0]].pt  +   event.Jet[:,pairing[1]].pt
-        diJet['dr']   = event.Jet[:,pairing[0]].delta_r(event.Jet[:,pairing[1]])
-        diJet['lead'] = event.Jet[:,pairing[0]]
-        diJet['subl'] = event.Jet[:,pairing[1]]
-        # Sort diJets within pairings to be lead st, subl st
-        diJet = diJet[ak.argsort(diJet.st, axis=2, ascending=False)]
-        # Now indexed by diJet[event,pairing,lead/subl st]
+        pairing = [np.array([[0,2],[0,1],[0,1]]),
+                   np.array([[1,3],[2,3],[3,2]])]
+        # Sort diJets within pairings to be lead st, subl st by swapping the jet indices of the two diJets
+        st   = jet_pt[:,pairing[0]] + jet_pt[:,pairing[1]]
+        swap = (st[:,:,0] < st[:,:,1])[:,:,np.newaxis]
+        j0   = np.where(swap, pairing[0][:,::-1], pairing[0])
+        j1   = np.where(swap, pairing[1][:,::-1], pairing[1])
+        # Now indexed by j0/j1[event,pairing,lead/subl st]
+
+        # Compute all diJet quantities as numpy arrays first so each record is built in a single ak.zip
+        diJet_px, diJet_py, diJet_pz, diJet_E = [gather(jet, j0) + gather(jet, j1) for jet in [jet_px, jet_py, jet_pz, jet_E]]
+        diJet_mass = np.sqrt(np.maximum(diJet_E**2 - diJet_px**2 - diJet_py**2 - diJet_pz**2, 0))
+        diJet_st   = np.where(swap, st[:,:,::-1], st)
+        diJet_dr   = np.sqrt((gather(jet_eta, j0) - gather(jet_eta, j1))**2 + delta_phi(gather(jet_phi, j0), gather(jet_phi, j1))**2)
 
         # Compute diJetMass cut with independent min/max for lead/subl
-        minDiJetMass = np.array([[[ 52, 50]]])
-        maxDiJetMass = np.array([[[180,173]]])
-        diJet['diJetMass'] = (minDiJetMass < diJet.mass) & (diJet.mass < maxDiJetMass)
+        diJet_diJetMass = (minDiJetMass < diJet_mass) & (diJet_mass < maxDiJetMass)
 
         # Compute sliding window delta_r criteria (drc)
-        min_m4j_scale = np.array([[ 360, 235]])
-        min_dr_offset = np.array([[-0.5, 0.0]])
-        max_m4j_scale = np.array([[ 650, 650]])
-        max_dr_offset = np.array([[ 0.5, 0.7]])
-        max_dr        = np.array([[ 1.5, 1.5]])
-        m4j = np.repeat(np.reshape(np.array(event.v4j.mass), (-1,1,1)), 2, axis=2)
-        diJet['drc'] = (min_m4j_scale/m4j + min_dr_offset < diJet.dr) & (diJet.dr < np.maximum(max_m4j_scale/m4j + max_dr_offset, max_dr))
+        m4j = m4j[:,np.newaxis,np.newaxis] # broadcasts against the lead/subl axis without a copy
+        diJet_drc = (min_m4j_scale/m4j + min_dr_offset < diJet_dr) & (diJet_dr < np.maximum(max_m4j_scale/m4j + max_dr_offset, max_dr))
 
         # Compute consistency of diJet masses with higgs boson mass
-        mH = 125.0
-        st_bias = np.array([[[1.02, 0.98]]])
-        cH = mH * st_bias
-        diJet['xH'] = (diJet.mass - cH)/(0.1*diJet.mass)
+        diJet_xH = (diJet_mass - cH)/(np.float32(0.1)*diJet_mass)
+
+        diJet_pt  = np.hypot(diJet_px, diJet_py)
+        diJet_eta = np.arcsinh(diJet_pz/diJet_pt)
+        diJet_phi = np.arctan2(diJet_py, diJet_px)
+
+        # Plain records without vector behavior, derived quantities are stored as fields instead of being recomputed on access
+        lead = ak.zip({var: gather(jet, j0) for var, jet in zip(['pt','eta','phi','mass'], [jet_pt, jet_eta, jet_phi, jet_mass])})
+        subl = ak.zip({var: gather(jet, j1) for var, jet in zip(['pt','eta','phi','mass'], [jet_pt, jet_eta, jet_phi, jet_mass])})
+        diJet = ak.zip({'x': diJet_px, 'y': diJet_py, 'z': diJet_pz, 't': diJet_E,
+                        'pt': diJet_pt, 'eta': diJet_eta, 'phi': diJet_phi, 'mass': diJet_mass,
+                        'st': diJet_st,
+                        'dr': diJet_dr,
+                        'lead': lead,
+                        'subl': subl,
+                        'diJetMass': diJet_diJetMass,
+                        'drc': diJet_drc,
+                        'xH': diJet_xH,
+                        })
 
         #
         # Build quadJets
         #
+        quadJet_dr = np.sqrt((diJet_eta[:,:,0] - diJet_eta[:,:,1])**2 + delta_phi(diJet_phi[:,:,0], diJet_phi[:,:,1])**2)
+        # Compute Region
+        quadJet_xHH = np.sqrt(diJet_xH[:,:,0]**2 + diJet_xH[:,:,1]**2)
+        quadJet_SR = quadJet_xHH < max_xHH
+        quadJet_diJetMass = diJet_diJetMass[:,:,0] & diJet_diJetMass[:,:,1]
+        quadJet_SB = quadJet_diJetMass & ~quadJet_SR
+
+        # rank quadJets at random giving preference to ones which pass diJetMass and drc's, the selected one comes from process_events
+        quadJet_rank = 10*diJet_diJetMass[:,:,0] + 10*diJet_diJetMass[:,:,1] + diJet_drc[:,:,0] + diJet_drc[:,:,1] + random
+
         quadJet = ak.zip({'lead': diJet[:,:,0],
                           'subl': diJet[:,:,1],
-                          'diJetMass': ak.all(diJet.diJetMass, axis=2),
-                          'random': np.random.uniform(low=0.1, high=0.9, size=(diJet.__len__(), 3))
+                          'diJetMass': quadJet_diJetMass,
+                          'random': random,
+                          'dr': quadJet_dr,
+                          'xHH': quadJet_xHH,
+                          'SR': quadJet_SR,
+                          'SB': quadJet_SB,
+                          'rank': quadJet_rank,
+                          'selected': np.arange(3) == selected[:,np.newaxis],
                           })#, with_name='quadJet')
-        quadJet['dr'] = quadJet['lead'].delta_r(quadJet['subl'])
-        # Compute Region
-        quadJet['xHH'] = np.sqrt(quadJet.lead.xH**2 + quadJet.subl.xH**2)
-        max_xHH = 1.9
-        quadJet['SR'] = quadJet.xHH < max_xHH
-        quadJet['SB'] = quadJet.diJetMass & ~quadJet.SR
-        
-        # pick quadJet at random giving preference to ones which pass diJetMass and drc's
-        quadJet['rank'] = 10*quadJet.lead.diJetMass + 10*quadJet.subl.diJetMass + quadJet.lead.drc + quadJet.subl.drc + quadJet.random
-        quadJet['selected'] = quadJet.rank == np.max(quadJet.rank, axis=1)
 
         event[  'diJet'] =   diJet
         event['quadJet'] = quadJet
-        event['quadJet_selected'] = quadJet[quadJet.selected][:,0]
-        event['diJetMass'] = event.quadJet_selected.diJetMass
-        event['SB'] = event.quadJet_selected.SB
-        event['SR'] = event.quadJet_selected.SR
-
-        mask = event.preselection
-        self.fill(output, event[mask], dataset=dataset, cut='preselection', region='inclusive')
-        mask = event.preselection & event.diJetMass
-        self.fill(output, event[mask], dataset=dataset, cut='preselection', region='diJetMass')
-        mask = event.preselection & event.SB
-        self.fill(output, event[mask], dataset=dataset, cut='preselection', region='SB')
-        mask = event.preselection & event.SR
-        self.fill(output, event[mask], dataset=dataset, cut='preselection', region='SR')
-
-        if self.save:
-            util.save(event, dataset.replace('.root',f'_{estart:07d}_{estop:07d}.coffea'))
-                
-        # Done
-        elapsed = time.time() - tstart
-        if self.debug: print(f'{chunk}{nEvent/elapsed:,.0f} events/s')
-        return output
+        event['quadJet_selected'] = quadJet[np.arange(len(selected)), selected]
 
-    def fill(self, output, event, dataset='', cut='', region=''):
-        output['cutflow'].fill(
-            dataset=dataset, cut=cut, region=[region]*len(event),
-            weight=event.weight)
-        output['hists']['m4j'].fill(
-            dataset=dataset, cut=cut, region=region,
-            mass=event.v4j.mass, weight=event.weight)
-        output['hists']['lead_st_m2j_subl_st_m2j'].fill(
-            dataset=dataset, cut=cut, region=region,
-            lead=event.quadJet_selected.lead.mass, subl=event.quadJet_selected.subl.mass, weight=event.weight)
-        output['hists']['lead_st_dr_subl_st_dr'].fill(
-            dataset=dataset, cut=cut, region=region,
-            lead=event.quadJet_selected.lead.dr, subl=event.quadJet_selected.subl.dr, weight=event.weight)
-        if 'FvT_rw' in output['hists']:
-            output['hists']['FvT_rw'].fill(
-                dataset=dataset, cut=cut, region=region,
-                rw=event.FvT.rw, weight=event.weight)
-            
     def postprocess(self, accumulator):
-        pass
+        # Rebuild hists with a dataset axis from the sumw/sumw2 arrays accumulated over all chunks
+        for name in hist_axes:
+            dense = accumulator['cutflow'] if name == 'cutflow' else accumulator['hists'].get(name)
+            if not dense:
+                continue
+            h = book(name, hist.axis.StrCategory(list(dense), growth=True, name='dataset', label='Dataset'))
+            view = h.view(flow=True)
+            for i, (sumw, sumw2) in enumerate(dense.values()):
+                view.value[i], view.variance[i] = sumw, sumw2
+            if name == 'cutflow':
+                accumulator['cutflow'] = h
+            else:
+                accumulator['hists'][name] = h
+        return accumulator
 
 
 